@@ -17,8 +17,12 @@ def check_ffmpeg():
     except (subprocess.SubprocessError, FileNotFoundError):
         return False
 
-def convert_video(input_video, output_dir=None):
-    """转换视频为浏览器兼容格式"""
+def convert_video(input_video, output_dir=None, interactive=True):
+    """转换视频为浏览器兼容格式
+
+    interactive为False时（例如由watch_videos.py调用）不会询问是否更新JSON，
+    并且直接覆盖已存在的输出文件，避免FFmpeg等待终端输入。
+    """
     # 如果未指定输出目录，则使用默认目录
     if output_dir is None:
         output_dir = os.path.join("videos", "converted")
@@ -37,8 +41,11 @@ def convert_video(input_video, output_dir=None):
     print(f"输出文件: {output_file}")
     
     # 构建FFmpeg命令
-    ffmpeg_cmd = [
-        'ffmpeg', '-i', input_video,
+    ffmpeg_cmd = ['ffmpeg']
+    if not interactive:
+        ffmpeg_cmd += ['-nostdin', '-y']
+    ffmpeg_cmd += [
+        '-i', input_video,
         '-c:v', 'libx264',
         '-profile:v', 'baseline',
         '-level', '3.0',
@@ -62,7 +69,7 @@ def convert_video(input_video, output_dir=None):
         print('</video>')
         
         # 检查是否存在questionnaire_data.json，如果存在则提示更新
-        if os.path.exists("questionnaire_data.json"):
+        if interactive and os.path.exists("questionnaire_data.json"):
             print("\n您可能需要更新questionnaire_data.json文件中的视频路径。")
             print(f'将原路径 "{input_video}" 替换为 "{output_file}"')
             
@@ -0,0 +1,524 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import tempfile
+import argparse
+import threading
+
+from convert_video import check_ffmpeg, convert_video
+
+# watchdog is optional: without it the drop directory is polled instead
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+VIDEO_EXTENSIONS = ('.mp4', '.webm', '.mov', '.mkv', '.avi')
+PARTIAL_SUFFIXES = ('.part', '.tmp', '.crdownload', '.download')
+
+def is_candidate(file_name):
+    """Return True if a file in the drop directory is a recording or a sidecar JSON."""
+    if file_name.startswith('.') or file_name.endswith(PARTIAL_SUFFIXES):
+        return False
+    ext = os.path.splitext(file_name)[1].lower()
+    return ext in VIDEO_EXTENSIONS or ext == '.json'
+
+def find_recording(drop_dir, stem):
+    """Return the path of the recording named `stem` in the drop directory, if any."""
+    for ext in VIDEO_EXTENSIONS:
+        for candidate in (stem + ext, stem + ext.upper()):
+            path = os.path.join(drop_dir, candidate)
+            if os.path.isfile(path):
+                return path
+    return None
+
+def append_entries(path, entries, opening, empty_document):
+    """
+    Append serialized entries to the outermost container of a JSON array or a
+    JS object literal without re-serializing the existing content.
+
+    The existing bytes up to the closing token are copied into a temporary file
+    next to `path`, followed by the new entries, and the temporary file is then
+    renamed over `path`. Readers (and a crash mid-write) therefore always see a
+    complete document, either the old or the new one.
+
+    Args:
+        path (str): File to update
+        entries (list): Already serialized, indented entries (str)
+        opening (str): Opening token of the container ('[' or '{')
+        empty_document (str): Content used if the file does not exist yet
+    """
+    if not entries:
+        return
+
+    closing = b']' if opening == '[' else b'}'
+    if os.path.exists(path):
+        src = open(path, 'rb')
+    else:
+        src = io.BytesIO(empty_document.encode('utf-8'))
+
+    with src:
+        src.seek(0, os.SEEK_END)
+        tail_start = max(0, src.tell() - 65536)
+        src.seek(tail_start)
+        tail = src.read()
+
+        end = tail.rfind(closing)
+        if end < 0:
+            raise ValueError(f"No closing '{closing.decode()}' found in {path}")
+        before = tail[:end].rstrip()
+        separator = b'' if before.endswith(opening.encode()) else b','
+        payload = separator + b'\n' + ',\n'.join(entries).encode('utf-8') + b'\n'
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                        prefix=f".{os.path.basename(path)}.", suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as dst:
+                src.seek(0)
+                remaining = tail_start + len(before)
+                while remaining > 0:
+                    chunk = src.read(min(remaining, 1024 * 1024))
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    remaining -= len(chunk)
+                dst.write(payload + tail[end:])
+                dst.flush()
+                os.fsync(dst.fileno())
+            if os.path.exists(path):
+                shutil.copymode(path, tmp_path)
+            else:
+                os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+class Publisher:
+    """
+    Keeps the question pool and video mapping up to date with newly extracted
+    clips. Existing ids and mapping keys are loaded once at startup; afterwards
+    every clip is appended to both files instead of regenerating them.
+    """
+
+    def __init__(self, pool_file, mapping_file, base_url):
+        self.pool_file = pool_file
+        self.mapping_file = mapping_file
+        self.base_url = base_url.rstrip('/')
+        self._lock = threading.Lock()
+
+        self._pool_ids = set()
+        if os.path.exists(pool_file):
+            with open(pool_file, 'r', encoding='utf-8') as f:
+                self._pool_ids = {item['id'] for item in json.load(f) if 'id' in item}
+
+        self._mapping_keys = set()
+        if os.path.exists(mapping_file):
+            with open(mapping_file, 'r', encoding='utf-8') as f:
+                content = f.read()
+            self._mapping_keys = set(json.loads(content[content.index('{'):content.rindex('}') + 1]))
+
+        print(f"Loaded {len(self._pool_ids)} questions from {pool_file}")
+        print(f"Loaded {len(self._mapping_keys)} video mappings from {mapping_file}")
+
+    def is_published(self, sample_id):
+        with self._lock:
+            return sample_id in self._pool_ids
+
+    def publish(self, sample, clip_name):
+        """Append one question and its clip URL, skipping anything already present."""
+        with self._lock:
+            if clip_name not in self._mapping_keys:
+                entry = f"  {json.dumps(clip_name)}: {json.dumps(f'{self.base_url}/{clip_name}')}"
+                append_entries(self.mapping_file, [entry], '{', 'window.videoFileMapping = {\n};\n')
+                self._mapping_keys.add(clip_name)
+
+            # The mapping goes first so a question never shows up without its video
+            if sample['id'] not in self._pool_ids:
+                entry = json.dumps(sample, indent=2, ensure_ascii=False).replace('\n', '\n  ')
+                append_entries(self.pool_file, ['  ' + entry], '[', '[\n]\n')
+                self._pool_ids.add(sample['id'])
+
+def load_sidecar_samples(sidecar_path, stem, clip_length):
+    """
+    Load the questions for a recording from its sidecar JSON file.
+
+    The sidecar holds a list of samples in the additional questionnaire format.
+    `domain`, `groundTruth`, `negative_comments` and `video_time` are required;
+    `is_ge` and `take_name` default to false and the recording name. Each
+    sample may set `start_time`/`end_time`; otherwise the clip starts at
+    `video_time` and lasts `clip_length` seconds.
+
+    Every sample gets its own clip id, `{domain}_{ge|tips}_{take_name}_{video_time}`
+    (the naming used by video_mapping.js). A supplied `id` is used as the prefix
+    instead of `{domain}_{ge|tips}_{take_name}` and gets `_{video_time}` appended
+    unless it already ends with it.
+
+    Returns:
+        list: (sample, start_time, end_time) tuples
+    """
+    if not os.path.exists(sidecar_path):
+        return []
+
+    try:
+        with open(sidecar_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except ValueError as e:
+        print(f"Skipping {sidecar_path} due to invalid JSON: {e}")
+        return []
+    if not isinstance(data, list):
+        print(f"Skipping {sidecar_path}: expected a list of samples")
+        return []
+
+    samples = []
+    seen_ids = set()
+    for i, sample in enumerate(data):
+        if not isinstance(sample, dict):
+            print(f"Skipping sample {i+1} in {sidecar_path} because it is not an object")
+            continue
+        if not sample.get('groundTruth') or not sample.get('negative_comments') or 'domain' not in sample:
+            print(f"Skipping sample {i+1} in {sidecar_path} due to missing domain, ground truth or negative comments")
+            continue
+
+        video_time = sample.get('video_time')
+        if video_time is None:
+            print(f"Skipping sample {i+1} in {sidecar_path} due to missing video_time")
+            continue
+
+        try:
+            start_time = float(sample.get('start_time', video_time))
+            end_time = float(sample.get('end_time', start_time + clip_length))
+        except (TypeError, ValueError):
+            print(f"Skipping sample {i+1} in {sidecar_path} due to invalid start or end time")
+            continue
+        if end_time <= start_time:
+            print(f"Skipping sample {i+1} in {sidecar_path} due to end_time not after start_time")
+            continue
+
+        sample = dict(sample)
+        sample['domain'] = str(sample['domain'])
+        sample['take_name'] = str(sample.get('take_name') or stem)
+        # Same naming as the existing clips, e.g. basketball_ge_sfu_basketball012_3_10.952002
+        sample_type = 'ge' if sample.get('is_ge') else 'tips'
+        sample_id = str(sample.get('id') or f"{sample['domain']}_{sample_type}_{sample['take_name']}")
+        if not sample_id.endswith(f"_{video_time}"):
+            sample_id = f"{sample_id}_{video_time}"
+        if sample_id in seen_ids:
+            print(f"Skipping sample {i+1} in {sidecar_path} due to duplicate id {sample_id}")
+            continue
+        seen_ids.add(sample_id)
+        sample['id'] = sample_id
+
+        samples.append((sample, start_time, end_time))
+
+    return samples
+
+def process_recording(stem, args, publisher):
+    """
+    Convert a recording (if its converted copy is missing or stale), extract
+    a clip for every new sample in its sidecar and publish each clip as soon
+    as it is written.
+
+    Returns:
+        bool: False if anything failed and the recording should be retried
+    """
+    video_path = find_recording(args.drop_dir, stem)
+    if video_path is None:
+        return True
+
+    converted_path = os.path.join(args.converted_dir, f"{stem}_converted.mp4")
+    if not os.path.exists(converted_path) or os.path.getmtime(converted_path) < os.path.getmtime(video_path):
+        # Convert into a staging directory so a crash never leaves a truncated
+        # file that looks up to date on the next start
+        staging_dir = os.path.join(args.converted_dir, '.staging')
+        staged_path = convert_video(video_path, staging_dir, interactive=False)
+        if staged_path is None:
+            staged_path = os.path.join(staging_dir, f"{stem}_converted.mp4")
+            if os.path.exists(staged_path):
+                os.remove(staged_path)
+            return False
+        os.replace(staged_path, converted_path)
+
+    sidecar_path = os.path.join(args.drop_dir, f"{stem}.json")
+    samples = load_sidecar_samples(sidecar_path, stem, args.clip_length)
+    samples = [s for s in samples if not publisher.is_published(s[0]['id'])]
+    if not samples:
+        return True
+
+    # decord/cv2 are only needed once there are segments to extract
+    from download_videos_for_web import download_video_segment
+
+    os.makedirs(args.clips_dir, exist_ok=True)
+    success = True
+    for sample, start_time, end_time in samples:
+        clip_name = f"{sample['id']}.mp4"
+        clip_path = os.path.join(args.clips_dir, clip_name)
+        staged_clip = os.path.join(args.clips_dir, f".{sample['id']}.part.mp4")
+
+        if not download_video_segment(converted_path, start_time, end_time, staged_clip, args.width):
+            if os.path.exists(staged_clip):
+                os.remove(staged_clip)
+            success = False
+            continue
+
+        os.replace(staged_clip, clip_path)
+        publisher.publish(sample, clip_name)
+        print(f"Published {sample['id']}")
+
+    return success
+
+class DropDirWatcher:
+    """
+    Tracks recordings in the drop directory and hands settled ones to the
+    worker pool. A recording (together with its sidecar JSON) counts as
+    settled once its size and modification time have not changed for
+    `settle_seconds`, so files that are still being copied are not picked up.
+    Recordings that fail are retried with an exponential backoff, starting at
+    `retry_seconds` and capped at `max_retry_seconds`, for up to
+    `max_attempts` attempts. After that, or after a permanent error, the
+    recording is left alone until one of its files changes.
+    """
+
+    def __init__(self, drop_dir, jobs, settle_seconds, retry_seconds=5, max_retry_seconds=300, max_attempts=5):
+        self.drop_dir = drop_dir
+        self.jobs = jobs
+        self.settle_seconds = settle_seconds
+        self.retry_seconds = retry_seconds
+        self.max_retry_seconds = max_retry_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._active = set()
+        self._settling = {}
+        self._done = {}
+        self._failures = {}
+        self._retry_at = {}
+
+    def mark(self, path):
+        """Note that a file in the drop directory was created or changed."""
+        file_name = os.path.basename(path)
+        if os.path.dirname(os.path.abspath(path)) != os.path.abspath(self.drop_dir) or not is_candidate(file_name):
+            return
+        with self._lock:
+            self._pending.add(os.path.splitext(file_name)[0])
+
+    def scan(self):
+        """Mark every candidate in the drop directory (startup and polling mode)."""
+        with os.scandir(self.drop_dir) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    self.mark(entry.path)
+
+    def finished(self, stem, success, permanent=False):
+        """
+        Release a recording after a worker is done with it. Failed recordings
+        are queued again later unless the failure is permanent or they have
+        run out of attempts; the attempt count restarts when the files change.
+        """
+        with self._lock:
+            self._active.discard(stem)
+            self._retry_at.pop(stem, None)
+            if success:
+                self._failures.pop(stem, None)
+                return
+
+            # _done still holds the signature of the files this attempt processed
+            signature = self._done.get(stem)
+            failed_signature, attempts = self._failures.get(stem, (None, 0))
+            attempts = attempts + 1 if failed_signature == signature else 1
+            self._failures[stem] = (signature, attempts)
+
+            if permanent or attempts >= self.max_attempts:
+                message = f"Giving up on {stem} after {attempts} attempt(s) until its files change"
+            else:
+                delay = min(self.retry_seconds * 2 ** (attempts - 1), self.max_retry_seconds)
+                self._retry_at[stem] = time.monotonic() + delay
+                self._done.pop(stem, None)
+                self._pending.add(stem)
+                message = f"Retrying {stem} in {delay:g}s"
+        print(message)
+
+    def _signature(self, stem):
+        video_path = find_recording(self.drop_dir, stem)
+        if video_path is None:
+            return None
+        try:
+            stat = os.stat(video_path)
+            if stat.st_size == 0:
+                return None
+            sidecar_path = os.path.join(self.drop_dir, f"{stem}.json")
+            sidecar = os.stat(sidecar_path) if os.path.exists(sidecar_path) else None
+        except FileNotFoundError:
+            return None
+        sidecar_signature = (sidecar.st_size, sidecar.st_mtime_ns) if sidecar else None
+        return (stat.st_size, stat.st_mtime_ns, sidecar_signature)
+
+    def tick(self):
+        """Queue every pending recording that has settled. Blocks while the queue is full."""
+        now = time.monotonic()
+        with self._lock:
+            stems = [stem for stem in self._pending if stem not in self._active]
+            retry_at = dict(self._retry_at)
+            failures = dict(self._failures)
+
+        for stem in stems:
+            signature = self._signature(stem)
+            if signature is None or signature == self._done.get(stem):
+                with self._lock:
+                    self._pending.discard(stem)
+                self._settling.pop(stem, None)
+                continue
+
+            # Wait out the backoff unless the files changed since the failure
+            if retry_at.get(stem, 0) > now and failures.get(stem, (None,))[0] == signature:
+                continue
+
+            last_signature, since = self._settling.get(stem, (None, now))
+            if signature != last_signature:
+                self._settling[stem] = (signature, now)
+                continue
+            if now - since < self.settle_seconds:
+                continue
+
+            del self._settling[stem]
+            self._done[stem] = signature
+            with self._lock:
+                self._pending.discard(stem)
+                self._active.add(stem)
+            self.jobs.put(stem)
+
+class _DropDirEventHandler(FileSystemEventHandler):
+    def __init__(self, watcher):
+        super().__init__()
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        if event.is_directory:
+            return
+        for path in (event.src_path, getattr(event, 'dest_path', None)):
+            if path:
+                self.watcher.mark(path)
+
+def worker_loop(jobs, watcher, args, publisher):
+    # Every worker exits by consuming exactly one sentinel, so shutdown never
+    # leaves sentinels stuck in the bounded queue
+    while True:
+        stem = jobs.get()
+        if stem is None:
+            break
+        success = False
+        permanent = False
+        try:
+            success = process_recording(stem, args, publisher)
+        except ImportError as e:
+            # e.g. decord/cv2 missing: retrying cannot help until the daemon is restarted
+            print(f"Error processing {stem}: {e}")
+            permanent = True
+        except Exception as e:
+            print(f"Error processing {stem}: {e}")
+        finally:
+            watcher.finished(stem, success, permanent)
+
+def main():
+    parser = argparse.ArgumentParser(description='Watch a drop directory and publish new recordings to the questionnaire')
+    parser.add_argument('--drop-dir', default='incoming',
+                        help='Directory where new recordings (and their sidecar JSON files) land')
+    parser.add_argument('--converted-dir', default=os.path.join('videos', 'converted'),
+                        help='Directory for browser compatible copies of the recordings')
+    parser.add_argument('--clips-dir', default='additional_video_clips',
+                        help='Directory to save extracted question clips')
+    parser.add_argument('--pool-file', default=os.path.join('additional_samples', 'filtered_unique_additional_questionnaire_data.json'),
+                        help='Question pool JSON file loaded by the domain questionnaires')
+    parser.add_argument('--mapping-file', default='video_mapping.js',
+                        help='Video mapping JS file')
+    parser.add_argument('--base-url', default=None,
+                        help='URL prefix for clips in the video mapping (default: the clips directory)')
+    parser.add_argument('--clip-length', type=float, default=5,
+                        help='Clip length in seconds for samples without end_time (default: 5)')
+    parser.add_argument('--width', type=int, default=640,
+                        help='Width of the extracted clips (default: 640)')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='Number of recordings processed in parallel (default: 2)')
+    parser.add_argument('--queue-size', type=int, default=8,
+                        help='Maximum number of settled recordings waiting for a worker (default: 8)')
+    parser.add_argument('--settle-seconds', type=float, default=2,
+                        help='Time a file must stay unchanged before it is processed (default: 2)')
+    parser.add_argument('--poll-interval', type=float, default=1,
+                        help='Polling interval in seconds (default: 1)')
+    parser.add_argument('--max-attempts', type=int, default=5,
+                        help='Attempts per recording before giving up until its files change (default: 5)')
+    parser.add_argument('--poll', action='store_true',
+                        help='Poll the drop directory even if watchdog is installed')
+
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.queue_size < 1:
+        parser.error('--queue-size must be at least 1')
+    if args.max_attempts < 1:
+        parser.error('--max-attempts must be at least 1')
+
+    if not check_ffmpeg():
+        print("错误: 未安装FFmpeg。请先安装FFmpeg。")
+        print("Ubuntu/Debian: sudo apt-get install ffmpeg")
+        print("MacOS: brew install ffmpeg")
+        sys.exit(1)
+
+    os.makedirs(args.drop_dir, exist_ok=True)
+    publisher = Publisher(args.pool_file, args.mapping_file, args.base_url or args.clips_dir)
+
+    jobs = queue.Queue(maxsize=args.queue_size)
+    watcher = DropDirWatcher(args.drop_dir, jobs, args.settle_seconds, max_attempts=args.max_attempts)
+    workers = [threading.Thread(target=worker_loop, args=(jobs, watcher, args, publisher), daemon=True)
+               for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+
+    observer = None
+    if Observer is not None and not args.poll:
+        observer = Observer()
+        observer.schedule(_DropDirEventHandler(watcher), args.drop_dir, recursive=False)
+        observer.start()
+        print(f"Watching {args.drop_dir}/ for new recordings (filesystem events)")
+    else:
+        print(f"Watching {args.drop_dir}/ for new recordings (polling every {args.poll_interval}s)")
+
+    # Pick up anything that landed while the watcher was not running
+    watcher.scan()
+    try:
+        while True:
+            if observer is None:
+                watcher.scan()
+            watcher.tick()
+            time.sleep(args.poll_interval if observer is None else min(args.poll_interval, 0.5))
+    except KeyboardInterrupt:
+        print("\nStopping...")
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
+        # Drop queued recordings so shutdown only waits for the ones in progress;
+        # they are picked up again on the next start. Nothing else adds to the
+        # queue now, and each sentinel put blocks at most until a busy worker
+        # finishes and takes one.
+        while True:
+            try:
+                jobs.get_nowait()
+            except queue.Empty:
+                break
+        for _ in workers:
+            jobs.put(None)
+        for worker in workers:
+            worker.join()
+
+if __name__ == '__main__':
+    main()